@@ -4,36 +4,79 @@ import sys
 import time
 import threading
 import socket
+import selectors
+import functools
+import itertools
+import collections
 import datetime
 import json
 import re
 import logging
-from queue import Queue
+import logging.handlers
+import atexit
+import email.utils
+from queue import Queue, Empty, Full
 from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import sqlite3
+# orjson is optional: it is used for settings.json, the attlog file, the export and the API bodies and replies when installed,
+# stdlib json otherwise
+try:
+    import orjson
+    jdumps = orjson.dumps
+    jloads = orjson.loads
+    def jdumps_indented(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def jdumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    jloads = json.loads
+    def jdumps_indented(obj):
+        return json.dumps(obj, indent=2).encode()
 
 # --- Load Settings ---
 SETTINGS_FILE = "settings.json"
 if not os.path.exists(SETTINGS_FILE):
     print(f"{SETTINGS_FILE} not found. Exiting.")
     sys.exit(1)
-with open(SETTINGS_FILE, 'r') as f:
-    settings = json.load(f)
+# Read once at startup; the raw bytes go straight to the parser
+with open(SETTINGS_FILE, 'rb') as f:
+    settings = jloads(f.read())
 
 DBID = settings.get("DBID")
 Token = settings.get("Token")
 devices = settings.get("devices", [])
+# Optional: records per API POST; 1 sends one JSON object per request, more sends them as one JSON array
+POST_BATCH_SIZE = max(1, int(settings.get("post_batch_size", 1)))
+# Optional: how many API POSTs may be in flight at once
+POST_WORKERS = max(1, int(settings.get("post_workers", 4)))
 if not DBID or not Token or not devices:
     print("DBID, Token and devices must be provided in settings.json. Exiting.")
     sys.exit(1)
 
 # --- Global Configuration ---
-ATTLOG_FILE = "attlog.json"
+# Append-only JSON Lines: one attendance record per line
+ATTLOG_FILE = "attlog.jsonl"
+# Bytes of raw ATTLOG requests waiting for the writer; a full queue stalls the request handlers
+PACKET_QUEUE_BYTES = 64 * 1024 * 1024
+# Threads answering complete device requests
+HANDLER_WORKERS = 64
 DB_FILE = "PUSH.db"
 POST_API_URL = f'https://appnostic.dbflex.net/secure/api/v2/{DBID}/{Token}/ZK_stage/create.json'
+POST_HEADERS = {
+    'Content-Type': 'application/json',
+    'Authorization': f'Bearer {Token}'
+}
+# Shared session so every POST reuses the same keep-alive TLS connection
+http_session = requests.Session()
+# Keep-alive connections kept per API host; failed connects are retried, failed reads only for GETs
+HTTP_POOL_SIZE = 16
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=3))
 # How long each command server cycle lasts (in seconds)
 RUN_INTERVAL = 43200
+# Longest the sync loop sleeps when nothing new is written (failed posts are retried this often)
+SYNC_INTERVAL = 10
 
 # --- Logging Setup (with ANSI colors) ---
 class CustomFormatter(logging.Formatter):
@@ -43,66 +86,135 @@ class CustomFormatter(logging.Formatter):
     RED = "\033[91m"
     PINK = "\033[95m"
     RESET = "\033[0m"
-    FORMATS = {
-        logging.INFO: "%(asctime)s - %(levelname)s - %(message)s",
-        'DEFAULT': "%(asctime)s - %(levelname)s - %(message)s"
+    FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+    # Log calls choose a colour with extra={'color': ...}; records without one are printed plain
+    COLORS = {
+        'green': GREEN,
+        'yellow': YELLOW,
+        'blue': BLUE,
+        'red': RED,
+        'pink': PINK
     }
+    def __init__(self):
+        super().__init__(self.FORMAT)
+        self.by_color = {name: logging.Formatter(code + self.FORMAT + self.RESET)
+                         for name, code in self.COLORS.items()}
     def format(self, record):
-        if "Connected by" in record.msg or "Server listening" in record.msg:
-            log_fmt = self.GREEN + "%(asctime)s - %(levelname)s - %(message)s" + self.RESET
-        elif "Received from" in record.msg:
-            log_fmt = self.YELLOW + "%(asctime)s - %(levelname)s - %(message)s" + self.RESET
-        elif "Writing to file" in record.msg or "Parsed JSON packet" in record.msg:
-            log_fmt = self.BLUE + "%(asctime)s - %(levelname)s - %(message)s" + self.RESET
-        elif "Closing connection" in record.msg:
-            log_fmt = self.RED + "%(asctime)s - %(levelname)s - %(message)s" + self.RESET
-        elif "Writing new entries to" in record.msg:
-            log_fmt = self.PINK + "%(asctime)s - %(levelname)s - %(message)s" + self.RESET
-        else:
-            log_fmt = self.FORMATS.get(record.levelno, self.FORMATS['DEFAULT'])
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.by_color.get(getattr(record, 'color', None))
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
 handler = logging.StreamHandler()
 handler.setFormatter(CustomFormatter())
-logging.basicConfig(level=logging.DEBUG, handlers=[handler])
+# Callers only enqueue records; the listener thread formats and writes them
+log_queue = Queue(-1)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.DEBUG, handlers=[queue_handler])
+log_listener = logging.handlers.QueueListener(log_queue, handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # --- Global Variables & Locks for Command Server ---
-global_counter = 1000
-counter_lock = threading.Lock()
-port_query_lock = threading.Lock()
-port_query_sent = {}  # key: port, value: bool
+# Command ids; next() on an itertools.count is atomic, so no lock is needed
+global_counter = itertools.count(1000)
+# key: port, present until that port's DATA QUERY is sent; dict.pop() claims it atomically, so no lock
+port_query_pending = {}
 shutdown_event = threading.Event()
+listen_sockets = {}  # key: port, value: listening socket (kept open across cycles)
+attlog_written = threading.Event()  # set by the writer after each append; wakes the sync loop
 
 # --- Helper Functions (Command Server Part) ---
+# Formatted once per second: (epoch second, "YYYY-mm-dd HH:MM:SS")
+_timestamp_cache = (None, "")
+
 def get_timestamp():
-    now = datetime.datetime.now()
-    ms = int(now.microsecond / 1000)
-    return now.strftime(f"%Y-%m-%d %H:%M:%S:{ms:03d}")
+    global _timestamp_cache
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _timestamp_cache
+    if second != cached_second:
+        prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _timestamp_cache = (second, prefix)
+    return f"{prefix}:{int((now - second) * 1000):03d}"
+
+# Fixed parts of every reply; only the Date header changes between "OK" responses
+RESPONSE_HEAD = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nAccept-Ranges: bytes\r\nConnection: close\r\nDate: "
+OK_RESPONSE_TAIL = b"\r\nContent-Length: 2\r\n\r\nOK"
+# Tail for any other body: "%d" takes its length
+RESPONSE_LENGTH_TAIL = b"\r\nContent-Length: %d\r\n\r\n"
+# Everything in the options=all reply after the "GET OPTION FROM:<SN>" line; it never changes
+OPTIONS_BODY_TAIL = (
+    b"Stamp=9999\n"
+    b"OpStamp=9999\n"
+    b"PhotoStamp=0\n"
+    b"TransFlag=TransData AttLog\tOpLog\tAttPhoto\tEnrollUser\tChgUser\tEnrollFP\tChgFP\tFPImag\tFACE\tUserPic\tWORKCODE\tBioPhoto\n"
+    b"ErrorDelay=120\n"
+    b"Delay=10\n"
+    b"TimeZone=120\n"
+    b"TransTimes=\n"
+    b"TransInterval=30\n"
+    b"SyncTime=0\n"
+    b"Realtime=1\n"
+    b"ServerVer=2.2.14 2025/02/19\n"
+    b"PushProtVer=2.4.1\n"
+    b"PushOptionsFlag=1\n"
+    b"ATTLOGStamp=9999\n"
+    b"OPERLOGStamp=9999\n"
+    b"ATTPHOTOStamp=0\n"
+    b"ServerName=Logtime Server\n"
+    b"MultiBioDataSupport=0:1:0:0:0:0:0:0:0:"
+)
+
+_date_header_cache = (None, b"")
 
 def get_date_header():
-    return datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
+    global _date_header_cache
+    second = int(time.time())
+    cached_second, value = _date_header_cache
+    if second != cached_second:
+        # formatdate spells day and month names itself, so the header doesn't follow the process locale
+        value = email.utils.formatdate(second, usegmt=True).encode()
+        _date_header_cache = (second, value)
+    return value
+
+# Devices are queried in GMT+2, matching their TimeZone=120 option
+DEVICE_TZ = datetime.timezone(datetime.timedelta(hours=2))
+ONE_DAY = datetime.timedelta(days=1)
 
 def extract_attlog(data):
-    cl_index = data.find("Content-Length:")
-    if cl_index == -1:
-        return None
-    cl_start = cl_index + len("Content-Length:")
-    cl_end = data.find("\n", cl_start)
-    try:
-        content_length = int(data[cl_start:cl_end].strip())
-    except ValueError:
+    # data is exactly one request (framed by request_length), so the body is everything after the headers
+    header_end, sep = data.find(b"\r\n\r\n"), 4
+    if header_end == -1:
+        header_end, sep = data.find(b"\n\n"), 2
+        if header_end == -1:
+            return None
+    # Left as bytes: the writer only decodes entries that can't go straight into the JSON template.
+    # One slice is the only copy; no strip() since split_attlog_records already skips blank lines
+    return data[header_end + sep:]
+
+SN_VALUE_RE = re.compile(rb'[^&\s]+')
+
+def extract_sn(data):
+    # SN is a query parameter, so only the request line is searched, never a large body
+    line_end = data.find(b"\n")
+    end = line_end if line_end != -1 else len(data)
+    # A plain substring search finds the key; the regex only has to match the value in place
+    start = data.find(b"SN=", 0, end)
+    if start == -1:
         return None
-    data_start = data.find("\n", cl_end) + 1
-    attlog_data = data[data_start:data_start+content_length].strip()
-    return attlog_data
+    m = SN_VALUE_RE.match(data, start + 3, end)
+    return m.group() if m else None  # raw bytes, like the ATTLOG body
 
-def extract_sn(data_str):
-    m = re.search(r'SN=([^&\s]+)', data_str)
-    return m.group(1) if m else None
+def split_attlog_records(record_bytes):
+    # Entries are split on whitespace later, so lines only need filtering, not stripping
+    return [line for line in record_bytes.splitlines() if line and not line.isspace()]
 
-def split_attlog_records(record_str):
-    return [line.strip() for line in record_str.strip().splitlines() if line.strip()]
+@functools.lru_cache(maxsize=None)
+def extra_column_keys(count):
+    # ("col1", ..., "colN") for the fields after attype, built once per distinct width
+    return tuple(f"col{i}" for i in range(1, count + 1))
 
 def parse_log_entry(entry):
     tokens = entry.split()
@@ -110,56 +222,198 @@ def parse_log_entry(entry):
         return None
     record = {
         "ZKID": tokens[0],
-        "timestamp": tokens[1] + " " + tokens[2],
+        "timestamp": f"{tokens[1]} {tokens[2]}",
         "inorout": tokens[3],
         "attype": tokens[4]
     }
-    for i, token in enumerate(tokens[5:], start=1):
-        record[f"col{i}"] = token
+    if len(tokens) > 5:
+        record.update(zip(extra_column_keys(len(tokens) - 5), tokens[5:]))
     return record
 
+# Bytes JSON would have to escape, plus \x1c-\x1f which str.split() (but not bytes.split()) treats as whitespace
+JSON_UNSAFE_RE = re.compile(rb'["\\\x00-\x08\x0e-\x1f]')
+
+@functools.lru_cache(maxsize=None)
+def record_template(extra_count):
+    # Same keys and order as parse_log_entry plus SN and log_timestamp, as one %-template per width
+    cols = "".join(f',"{key}":"%s"' for key in extra_column_keys(extra_count))
+    return ('{"ZKID":"%s","timestamp":"%s %s","inorout":"%s","attype":"%s"' + cols +
+            ',"SN":"%s","log_timestamp":"%s"}\n').encode()
+
+def encode_log_entry(entry, sn_value, log_timestamp):
+    """Return (attlog.jsonl line, dedup key) for one raw ATTLOG entry (entry and sn_value are bytes), or None if malformed."""
+    if (entry.isascii() and sn_value.isascii()
+            and not (JSON_UNSAFE_RE.search(entry) or JSON_UNSAFE_RE.search(sn_value))):
+        tokens = entry.split()
+        if len(tokens) < 5:
+            return None
+        line = record_template(len(tokens) - 5) % (*tokens, sn_value, log_timestamp.encode())
+        # The key comes from the same tokens as the line; entries can be bytearray slices
+        return line, (bytes(tokens[0]), bytes(tokens[1] + b" " + tokens[2]), bytes(sn_value))
+    # Rare: non-ASCII text, quotes, backslashes or control bytes go through a real decode and JSON encoder
+    record = parse_log_entry(entry.decode('utf-8', 'ignore'))
+    if record is None:
+        return None
+    record["SN"] = sn_value.decode('utf-8', 'ignore')
+    record["log_timestamp"] = log_timestamp
+    return jdumps(record) + b"\n", record_key(record)
+
+# Most kernels accept at most this many buffers per writev call
+IOV_MAX = 1024
+# Records the writer remembers to drop ones a device sends again (devices re-send the queried ATTLOG range)
+SEEN_RECORDS_MAX = 100000
+
+def record_key(record):
+    # (ZKID, "date time", SN) as bytes, the identity of one attendance record
+    return tuple(str(record.get(key, "")).encode() for key in ("ZKID", "timestamp", "SN"))
+class PacketQueue(Queue):
+    """Queue of (client_address, raw request) packets whose maxsize counts request bytes, not packets."""
+    # Requests run up to MAX_REQUEST_SIZE, so a packet count would not bound memory
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.queued_bytes = 0
+
+    @staticmethod
+    def packet_bytes(item):
+        # The None sentinel counts as one byte so get() still sees it
+        return 1 if item is None else max(1, len(item[1]))
+
+    def _qsize(self):
+        return self.queued_bytes
+
+    def _put(self, item):
+        super()._put(item)
+        self.queued_bytes += self.packet_bytes(item)
+
+    def _get(self):
+        item = super()._get()
+        self.queued_bytes -= self.packet_bytes(item)
+        return item
+
+# Packets the writer takes off the queue per write; keeps a burst of large uploads from all landing in memory at once
+WRITE_BATCH_SIZE = 256
+# Appended records are fsync'd at most this many seconds after they are written
+FSYNC_INTERVAL = 0.5
+
+def append_lines(fd, lines):
+    # writev hands the kernel the encoded lines as-is, without building a joined copy
+    for start in range(0, len(lines), IOV_MAX):
+        chunk = lines[start:start + IOV_MAX]
+        written = os.writev(fd, chunk) if hasattr(os, "writev") else 0
+        rest = b"".join(chunk)[written:] if written < sum(map(len, chunk)) else b""
+        while rest:
+            rest = rest[os.write(fd, rest):]
+
 def write_to_file(queue, filename):
-    while True:
-        json_packet = queue.get()
-        if json_packet is None:
-            break
-        raw_attlog = json_packet.get("attlog", "")
-        record_list = split_attlog_records(raw_attlog)
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
+    # Each record is appended as one JSON line; the file is never re-read or rewritten here
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+    # Keys of the newest records already in the file, oldest first
+    seen = collections.OrderedDict.fromkeys(record_key(record) for record in read_attlog_records(filename)[0])
+    while len(seen) > SEEN_RECORDS_MAX:
+        seen.popitem(last=False)
+    try:
+        running = True
+        unsynced = False
+        last_sync = time.monotonic()
+        while running:
+            # Block for one packet, then take already-queued ones up to WRITE_BATCH_SIZE in total.
+            # While written records await an fsync, the wait is bounded so an idle writer still syncs them.
+            try:
+                batch = [queue.get(timeout=FSYNC_INTERVAL) if unsynced else queue.get()]
+            except Empty:
+                os.fsync(fd)
+                unsynced = False
+                last_sync = time.monotonic()
+                continue
+            try:
+                while len(batch) < WRITE_BATCH_SIZE:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            # Nothing join()s this queue, so taken packets are not marked task_done
+            lines = []
+            debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+            for packet in batch:
+                if packet is None:
+                    running = False
+                    continue
+                client_address, raw = packet
                 try:
-                    data = json.load(f)
-                    if not isinstance(data, list):
-                        data = []
-                except json.JSONDecodeError:
-                    data = []
-        else:
-            data = []
-        sn_value = json_packet.get("sn", "")
-        for entry in record_list:
-            record_dict = parse_log_entry(entry)
-            if record_dict is None:
+                    # Handlers queue the raw request; all decoding and parsing happens here
+                    attlog_data, sn_value = extract_attlog(raw), extract_sn(raw)
+                    if not (attlog_data and sn_value):
+                        continue
+                    record_list = split_attlog_records(attlog_data)
+                    logging.info("Parsed ATTLOG packet from %s (SN %s): %d lines",
+                                 client_address, sn_value.decode('utf-8', 'ignore'), len(record_list), extra={'color': 'blue'})
+                    for entry in record_list:
+                        encoded = encode_log_entry(entry, sn_value, get_timestamp())
+                        if encoded is None:
+                            continue
+                        line, key = encoded
+                        if key in seen:
+                            continue
+                        seen[key] = None
+                        if len(seen) > SEEN_RECORDS_MAX:
+                            seen.popitem(last=False)
+                        lines.append(line)
+                        if debug_enabled:
+                            logging.debug(f"New record added: {line.decode().rstrip()}")
+                except Exception as e:
+                    # A malformed upload loses its remaining entries, never the writer thread
+                    logging.error(f"Error parsing ATTLOG packet from {client_address}: {e}")
+            if lines:
+                append_lines(fd, lines)
+                unsynced = True
+                attlog_written.set()
+            if unsynced and time.monotonic() - last_sync >= FSYNC_INTERVAL:
+                os.fsync(fd)
+                unsynced = False
+                last_sync = time.monotonic()
+    finally:
+        os.fsync(fd)
+        os.close(fd)
+
+def read_attlog_records(filename, start=0):
+    """Return the records on complete lines from byte offset start on, and the offset just past them."""
+    records = []
+    with open(filename, 'rb') as f:
+        if start > os.fstat(f.fileno()).st_size:
+            start = 0  # The file was replaced or truncated; read it again from the top
+        f.seek(start)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # The writer thread hasn't finished this line; it is read next time
+            start += len(line)
+            line = line.strip()
+            if not line:
                 continue
-            record_dict["SN"] = sn_value
-            record_dict["log_timestamp"] = get_timestamp()
-            if record_dict not in data:
-                data.append(record_dict)
-                logging.debug(f"New record added: {record_dict}")
-            else:
-                logging.debug(f"Duplicate record skipped: {record_dict}")
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=2)
-        queue.task_done()
+            try:
+                records.append(jloads(line))
+            except json.JSONDecodeError as e:
+                print("Error decoding JSON line:", e)
+    return records, start
+
+def compact_to_json_array(filename=ATTLOG_FILE, output="attlog.json"):
+    """Write the JSON Lines attendance log out as a single JSON array."""
+    # Serialise first and write once; json.dump would issue a write per token
+    records, _ = read_attlog_records(filename)
+    content = jdumps_indented(records)
+    with open(output, 'wb') as f:
+        f.write(content)
+    print(f"Wrote {output} from {filename}.")
 
-def handle_client(client_socket, client_address, server_port, queue):
-    global global_counter
+def handle_client(client_socket, client_address, server_port, queue, raw):
     try:
-        data = client_socket.recv(10240).decode(errors='ignore')
-        if not data:
+        if not raw:
             client_socket.close()
             return
-        logging.info(f"Received from {client_address} on port {server_port}:\n{data}")
-        request_line = data.splitlines()[0]
+        # Size only: a raw ATTLOG upload can be megabytes
+        logging.debug("Received from %s on port %s: %d bytes", client_address, server_port, len(raw),
+                      extra={'color': 'yellow'})
+        # Only the request line needs decoding to route the request
+        line_end = raw.find(b"\n")
+        request_line = str(raw[:line_end if line_end != -1 else len(raw)], 'utf-8', 'ignore')
         parts = request_line.split()
         if len(parts) < 2:
             client_socket.close()
@@ -168,153 +422,279 @@ def handle_client(client_socket, client_address, server_port, queue):
         parsed_url = urlparse(url)
         path = parsed_url.path
         qs = parse_qs(parsed_url.query)
-        logging.debug(f"DEBUG (port {server_port}): Query parameters from {client_address}: {qs}")
+        logging.debug("DEBUG (port %s): Query parameters from %s: %s", server_port, client_address, qs)
         # GET /iclock/getrequest – respond with dt1 as yesterday and dt2 as today in GMT+2
         if method.upper() == "GET" and path == "/iclock/getrequest":
-            from datetime import timedelta, timezone
-            tz = timezone(timedelta(hours=2))
-            now = datetime.datetime.now(tz)
+            now = datetime.datetime.now(DEVICE_TZ)
             dt2 = now.strftime("%Y-%m-%d")
-            dt1 = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+            dt1 = (now - ONE_DAY).strftime("%Y-%m-%d")
             if "INFO" in qs:
                 body = "OK"
             else:
-                with port_query_lock:
-                    sent = port_query_sent.get(server_port, False)
-                    if not sent:
-                        port_query_sent[server_port] = True
-                        with counter_lock:
-                            current_value = global_counter
-                            global_counter += 1
-                        body = f"C:{current_value}:DATA QUERY ATTLOG StartTime={dt1}\tEndTime={dt2}"
-                    else:
-                        body = "OK"
+                if port_query_pending.pop(server_port, False):
+                    current_value = next(global_counter)
+                    body = f"C:{current_value}:DATA QUERY ATTLOG StartTime={dt1}\tEndTime={dt2}"
+                else:
+                    body = "OK"
             body_bytes = body.encode()
-            header = (f"HTTP/1.1 200 OK\r\n"
-                      "Content-Type: text/plain\r\n"
-                      "Accept-Ranges: bytes\r\n"
-                      f"Date: {get_date_header()}\r\n"
-                      f"Content-Length: {len(body_bytes)}\r\n"
-                      "\r\n")
-            client_socket.sendall(header.encode())
-            client_socket.sendall(body_bytes)
+            client_socket.sendall(RESPONSE_HEAD + get_date_header() + RESPONSE_LENGTH_TAIL % len(body_bytes) + body_bytes)
             client_socket.close()
             return
         # POST /iclock/cdata?table=ATTLOG – add attlog data to queue
         if method.upper() == "POST" and path == "/iclock/cdata" and qs.get("table", [""])[0].upper() == "ATTLOG":
-            body = "OK"
-            attlog_data = extract_attlog(data)
-            sn_value = extract_sn(data)
-            if attlog_data and sn_value:
-                json_packet = {"attlog": attlog_data, "client": client_address, "sn": sn_value}
-                logging.info(f"Parsed JSON packet: {json.dumps(json_packet, indent=2)}")
-                logging.debug(f"Adding packet to queue: {json_packet}")
-                queue.put(json_packet)
-            body_bytes = body.encode()
-            header = (f"HTTP/1.1 200 OK\r\n"
-                      "Content-Type: text/plain\r\n"
-                      "Accept-Ranges: bytes\r\n"
-                      f"Date: {get_date_header()}\r\n"
-                      f"Content-Length: {len(body_bytes)}\r\n"
-                      "\r\n")
-            client_socket.sendall(header.encode())
-            client_socket.sendall(body_bytes)
+            # The raw request is queued as-is; the writer thread decodes and parses it
+            # Block until the writer catches up; the device gets no reply meanwhile, which holds back its next upload
+            while True:
+                try:
+                    queue.put((client_address, raw), timeout=5)
+                    break
+                except Full:
+                    logging.warning(f"Attlog queue full ({PACKET_QUEUE_BYTES} bytes); writer is stalled")
+            client_socket.sendall(RESPONSE_HEAD + get_date_header() + OK_RESPONSE_TAIL)
             client_socket.close()
             return
         # GET /iclock/cdata?options=all – return a fixed command string
         if method.upper() == "GET" and path == "/iclock/cdata" and qs.get("options", [""])[0] == "all":
             SN = qs.get("SN", [""])[0]
-            command_body = (
-                f"GET OPTION FROM:{SN}\n"
-                "Stamp=9999\n"
-                "OpStamp=9999\n"
-                "PhotoStamp=0\n"
-                "TransFlag=TransData AttLog\tOpLog\tAttPhoto\tEnrollUser\tChgUser\tEnrollFP\tChgFP\tFPImag\tFACE\tUserPic\tWORKCODE\tBioPhoto\n"
-                "ErrorDelay=120\n"
-                "Delay=10\n"
-                "TimeZone=120\n"
-                "TransTimes=\n"
-                "TransInterval=30\n"
-                "SyncTime=0\n"
-                "Realtime=1\n"
-                "ServerVer=2.2.14 2025/02/19\n"
-                "PushProtVer=2.4.1\n"
-                "PushOptionsFlag=1\n"
-                "ATTLOGStamp=9999\n"
-                "OPERLOGStamp=9999\n"
-                "ATTPHOTOStamp=0\n"
-                "ServerName=Logtime Server\n"
-                "MultiBioDataSupport=0:1:0:0:0:0:0:0:0:"
-            )
-            body_bytes = command_body.encode()
-            header = (f"HTTP/1.1 200 OK\r\n"
-                      "Content-Type: text/plain\r\n"
-                      "Accept-Ranges: bytes\r\n"
-                      f"Date: {get_date_header()}\r\n"
-                      f"Content-Length: {len(body_bytes)}\r\n"
-                      "\r\n")
-            client_socket.sendall(header.encode())
-            client_socket.sendall(body_bytes)
+            body_bytes = b"GET OPTION FROM:%s\n" % SN.encode() + OPTIONS_BODY_TAIL
+            client_socket.sendall(RESPONSE_HEAD + get_date_header() + RESPONSE_LENGTH_TAIL % len(body_bytes) + body_bytes)
             client_socket.close()
             return
         # Default response:
-        body = "OK"
-        body_bytes = body.encode()
-        header = (f"HTTP/1.1 200 OK\r\n"
-                  "Content-Type: text/plain\r\n"
-                  "Accept-Ranges: bytes\r\n"
-                  f"Date: {get_date_header()}\r\n"
-                  f"Content-Length: {len(body_bytes)}\r\n"
-                  "\r\n")
-        client_socket.sendall(header.encode())
-        client_socket.sendall(body_bytes)
+        client_socket.sendall(RESPONSE_HEAD + get_date_header() + OK_RESPONSE_TAIL)
         client_socket.close()
     except Exception as e:
         logging.error(f"Error handling client {client_address} on port {server_port}: {e}")
         client_socket.close()
 
-def start_server_on_port(host, port, queue):
-    with port_query_lock:
-        port_query_sent[port] = False
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((host, port))
-    server.listen(5)
-    server.settimeout(0.5)
-    logging.info(f"Server listening on {host}:{port}")
-    while not shutdown_event.is_set():
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+CONTENT_LENGTH_RE = re.compile(rb'^content-length:[ \t]*(\d+)', re.IGNORECASE | re.MULTILINE)
+SOCKET_BUFFER_SIZE = 65536
+# Kernel send/receive buffer floor; the OS default is kept when it is already larger
+SOCKET_KERNEL_BUFFER = 262144
+LISTEN_BACKLOG = 128  # Room for a whole fleet reconnecting at once
+# Connections that send nothing for this many seconds are closed
+CLIENT_IDLE_TIMEOUT = 60
+
+def tune_socket(sock):
+    """Disable Nagle, size the kernel buffers for a whole ATTLOG POST and ACK straight away where supported."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        if sock.getsockopt(socket.SOL_SOCKET, option) < SOCKET_KERNEL_BUFFER:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_KERNEL_BUFFER)
+    if hasattr(socket, "TCP_QUICKACK"):  # Linux only
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+def request_length(data, size):
+    """Return the total size of the HTTP request in data[:size] once its headers are in, else None."""
+    header_end, sep = data.find(b"\r\n\r\n", 0, size), 4
+    if header_end == -1:
+        header_end, sep = data.find(b"\n\n", 0, size), 2
+        if header_end == -1:
+            return None
+    m = CONTENT_LENGTH_RE.search(data, 0, header_end)
+    return header_end + sep + (int(m.group(1)) if m else 0)
+
+def get_listener(host, port):
+    """Return the listening socket for port, opening it on first use."""
+    server = listen_sockets.get(port)
+    if server is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        # Set before listen() so accepted connections start with the same options
+        tune_socket(server)
+        server.listen(LISTEN_BACKLOG)
+        server.setblocking(False)
+        listen_sockets[port] = server
+        logging.info(f"Server listening on {host}:{port}", extra={'color': 'green'})
+    return server
+
+# stop_serving() writes a byte here so the selector loop wakes at once instead of polling shutdown_event
+wakeup_reader, wakeup_writer = socket.socketpair()
+wakeup_reader.setblocking(False)
+
+def stop_serving():
+    shutdown_event.set()
+    wakeup_writer.send(b"\0")
+
+def serve_ports(host, ports, queue):
+    # One selector thread multiplexes every device port and its pending connections
+    sel = selectors.DefaultSelector()
+    # Every read lands in one reusable buffer; complete requests are copied out before the next recv
+    recv_buffer = bytearray(SOCKET_BUFFER_SIZE)
+    recv_view = memoryview(recv_buffer)
+    # Complete requests are answered on a fixed pool so a slow reply never holds up the selector
+    pool = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="zk")
+    # key: client socket still being read, value: time.monotonic() of its last read
+    last_active = {}
+
+    def accept_client(server_port, server):
         try:
             client_socket, client_address = server.accept()
-            threading.Thread(target=handle_client, args=(client_socket, client_address, port, queue), daemon=True).start()
-        except socket.timeout:
-            continue
-    server.close()
-    logging.info(f"Server on port {port} shutting down.")
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # e.g. the peer reset before accept or we ran out of descriptors; keep listening
+            logging.error(f"Error accepting on port {server_port}: {e}")
+            return
+        try:
+            client_socket.setblocking(False)
+            # Each reply is one small write; don't let Nagle hold it back waiting for an ACK
+            tune_socket(client_socket)
+        except OSError as e:
+            # e.g. the peer reset before its options were set; only this connection is dropped
+            logging.error(f"Error setting up client {client_address} on port {server_port}: {e}")
+            client_socket.close()
+            return
+        last_active[client_socket] = time.monotonic()
+        sel.register(client_socket, selectors.EVENT_READ,
+                     functools.partial(read_client, client_address, server_port, bytearray()))
+
+    def close_client(client_socket):
+        if client_socket in sel.get_map():
+            sel.unregister(client_socket)
+        last_active.pop(client_socket, None)
+        client_socket.close()
+
+    def dispatch(client_socket, client_address, server_port, data):
+        sel.unregister(client_socket)
+        del last_active[client_socket]
+        if not data:
+            client_socket.close()
+            return
+        client_socket.setblocking(True)
+        pool.submit(handle_client, client_socket, client_address, server_port, queue, data)
+
+    def receive(client_socket, client_address, server_port, view):
+        try:
+            n = client_socket.recv_into(view)
+        except OSError as e:
+            logging.error(f"Error reading from client {client_address} on port {server_port}: {e}")
+            close_client(client_socket)
+            return None
+        last_active[client_socket] = time.monotonic()
+        return n
+
+    def read_client(client_address, server_port, pending, client_socket):
+        # Until the headers are in, reads are accumulated in pending
+        n = receive(client_socket, client_address, server_port, recv_view)
+        if n is None:
+            return
+        if not n:
+            # Peer closed its side: handle whatever arrived
+            dispatch(client_socket, client_address, server_port, pending)
+            return
+        if pending:
+            pending += recv_view[:n]
+            data, size = pending, len(pending)
+        else:
+            data, size = recv_buffer, n
+        length = request_length(data, size)
+        if length is None and size < MAX_REQUEST_SIZE:
+            if not pending:
+                pending += recv_view[:n]
+            return
+        if length is None or length > MAX_REQUEST_SIZE:
+            logging.warning(f"Dropping oversized request from {client_address} on port {server_port}")
+            dispatch(client_socket, client_address, server_port, b"")
+        elif size >= length:
+            # Usually the whole request is in this one read and is sliced straight out of the buffer
+            if size > length:
+                # Replies carry "Connection: close", so nothing may follow the first request
+                logging.debug("Ignoring %d bytes after the request from %s on port %s", size - length, client_address, server_port)
+            dispatch(client_socket, client_address, server_port, data[:length])
+        else:
+            # Body still arriving: the buffer grows with what is received, not with the Content-Length the client claims
+            body = pending if pending else bytearray(recv_view[:n])
+            sel.modify(client_socket, selectors.EVENT_READ,
+                       functools.partial(read_body, client_address, server_port, body, length))
+
+    def read_body(client_address, server_port, body, length, client_socket):
+        n = receive(client_socket, client_address, server_port, recv_view[:length - len(body)])
+        if n is None:
+            return
+        body += recv_view[:n]
+        if n and len(body) < length:
+            return
+        dispatch(client_socket, client_address, server_port, body)
+
+    def drop_idle_clients():
+        deadline = time.monotonic() - CLIENT_IDLE_TIMEOUT
+        idle = [client_socket for client_socket, active in last_active.items() if active < deadline]
+        for client_socket in idle:
+            close_client(client_socket)
+        if idle:
+            logging.warning(f"Closed {len(idle)} connections idle for over {CLIENT_IDLE_TIMEOUT} seconds")
+
+    for port in ports:
+        port_query_pending[port] = True
+        sel.register(get_listener(host, port), selectors.EVENT_READ, functools.partial(accept_client, port))
+    # Drains the wakeup bytes; the loop condition then sees shutdown_event
+    sel.register(wakeup_reader, selectors.EVENT_READ, lambda sock: sock.recv(4096))
+    last_sweep = time.monotonic()
+    while not shutdown_event.is_set():
+        # The timeout only bounds how late idle connections are noticed
+        for key, _ in sel.select(CLIENT_IDLE_TIMEOUT):
+            try:
+                key.data(key.fileobj)
+            except OSError as e:
+                # Every port shares this loop, so a failing connection is closed on its own instead of ending it
+                logging.error(f"Error serving a connection: {e}")
+                if key.fileobj is not wakeup_reader and key.fileobj not in listen_sockets.values():
+                    close_client(key.fileobj)
+        if time.monotonic() - last_sweep >= CLIENT_IDLE_TIMEOUT:
+            drop_idle_clients()
+            last_sweep = time.monotonic()
+    sel.unregister(wakeup_reader)
+    # Close unfinished connections; the listening sockets stay open for the next cycle
+    for key in list(sel.get_map().values()):
+        if key.fileobj not in listen_sockets.values():
+            key.fileobj.close()
+    logging.info(f"Stopped serving ports {ports} for this cycle.")
+    # Let in-flight handlers finish queueing their packets before the writer is stopped
+    pool.shutdown(wait=True)
+    sel.close()
 
 def run_command_server(host, devices, queue, run_interval):
-    threads = []
-    for device in devices:
-        port = device.get('port')
-        with port_query_lock:
-            port_query_sent[port] = False
-        t = threading.Thread(target=start_server_on_port, args=(host, port, queue), daemon=True)
-        t.start()
-        threads.append(t)
-        logging.info(f"Started server on {host}:{port}")
+    ports = [device.get('port') for device in devices]
+    server_thread = threading.Thread(target=serve_ports, args=(host, ports, queue), daemon=True)
+    server_thread.start()
+    logging.info(f"Started server on {host} for ports {ports}")
     writer_thread = threading.Thread(target=write_to_file, args=(queue, ATTLOG_FILE), daemon=True)
     writer_thread.start()
     logging.info("File writer thread started.")
     logging.info(f"Command server running for {run_interval} seconds...")
     time.sleep(run_interval)
-    shutdown_event.set()
-    logging.info("Shutdown event set. Waiting for server threads to finish...")
-    for t in threads:
-        t.join(timeout=5)
+    stop_serving()
+    logging.info("Shutdown event set. Waiting for server thread to finish...")
+    server_thread.join(timeout=5)
+    # Let the writer drain what is queued, then sync and close the attlog file
+    queue.put(None)
     writer_thread.join(timeout=5)
     logging.info("Command server cycle stopped.")
 
 # --- Sync Process Functions ---
+# One long-lived connection per thread; sqlite3 connections may not be shared between threads
+_db_local = threading.local()
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # The sync loop's reads and writes stop blocking each other
+    "PRAGMA synchronous=NORMAL",  # One fsync per WAL checkpoint instead of per commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MiB page cache
+)
+
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        _db_local.conn = conn
+    return conn
+
 def initialize_database():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     # WARNING: This drops the existing table – adjust as needed.
     cursor.execute('DROP TABLE IF EXISTS attendance')
@@ -339,55 +719,103 @@ def initialize_database():
             RESPONSE TEXT
         )
     ''')
+    # One row per (ZKID, Timestamp); INSERT OR IGNORE leans on this to drop records already stored
+    cursor.execute('CREATE UNIQUE INDEX ux_attendance_zkid_timestamp ON attendance (ZKID, Timestamp)')
+    # Rows still waiting to be posted; post_records selects exactly this set
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_attendance_unposted ON attendance (id) WHERE RESPONSE IS NULL OR RESPONSE = ''")
     conn.commit()
-    conn.close()
     print("Database initialized.")
 
-def record_exists(cursor, zkid, timestamp_val):
-    cursor.execute('SELECT 1 FROM attendance WHERE ZKID = ? AND Timestamp = ?', (zkid, timestamp_val))
-    return cursor.fetchone() is not None
+# Columns filled from an attlog record, in INSERT order, with the record key and default for each
+ATTLOG_COLUMNS = (
+    ("ZKID", "ZKID", None),
+    ("Timestamp", "timestamp", None),
+    ("InorOut", "inorout", None),
+    ("attype", "attype", None),
+    ("col1", "col1", ""),
+    ("col2", "col2", ""),
+    ("col3", "col3", ""),
+    ("col4", "col4", ""),
+    ("col5", "col5", ""),
+    ("col6", "col6", ""),
+    ("col7", "col7", ""),
+    ("SN", "SN", ""),
+    ("log_timestamp", "log_timestamp", ""),
+)
+# Rows already stored hit the unique index and are skipped by SQLite
+INSERT_ATTENDANCE_SQL = (
+    f"INSERT OR IGNORE INTO attendance ({', '.join(column for column, _, _ in ATTLOG_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in ATTLOG_COLUMNS)})"
+)
+
+def attendance_row(record):
+    return tuple(record.get(key, default) for _, key, default in ATTLOG_COLUMNS)
+
+# Rows per multi-row INSERT; 64 rows x 13 columns stays under SQLite's 999 bound-parameter limit
+INSERT_CHUNK_ROWS = 64
+
+@functools.lru_cache(maxsize=None)
+def insert_attendance_sql(row_count):
+    # INSERT_ATTENDANCE_SQL already ends with one row of placeholders
+    values = f"({', '.join('?' for _ in ATTLOG_COLUMNS)})"
+    return INSERT_ATTENDANCE_SQL + "".join([", " + values] * (row_count - 1))
+
+def insert_attendance_rows(cursor, rows):
+    # Full chunks go in as one multi-row INSERT each; the remainder reuses the single-row statement
+    full = len(rows) - len(rows) % INSERT_CHUNK_ROWS
+    for start in range(0, full, INSERT_CHUNK_ROWS):
+        chunk = rows[start:start + INSERT_CHUNK_ROWS]
+        cursor.execute(insert_attendance_sql(INSERT_CHUNK_ROWS), list(itertools.chain.from_iterable(chunk)))
+    cursor.executemany(INSERT_ATTENDANCE_SQL, rows[full:])
+
+# Byte offset in ATTLOG_FILE up to which records are already in the database
+attlog_offset = 0
+# (ZKID, timestamp) keys known to be in the table, least recently seen first; re-sent records never reach SQLite
+RECENT_KEYS_MAX = 100000
+recent_keys = collections.OrderedDict()
+
+def remember_keys(keys):
+    for key in keys:
+        recent_keys[key] = None
+        recent_keys.move_to_end(key)
+    while len(recent_keys) > RECENT_KEYS_MAX:
+        recent_keys.popitem(last=False)
 
 def process_attlog_file():
-    try:
-        with open(ATTLOG_FILE, 'r') as file:
-            content = json.load(file)
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
-        return
-    conn = sqlite3.connect(DB_FILE)
+    global attlog_offset
+    content, end = read_attlog_records(ATTLOG_FILE, attlog_offset)
+    conn = get_db()
     cursor = conn.cursor()
+    rows = []
+    # Keys seen in this pass, so a record repeated within the file is only sent once
+    seen = set()
     for record in content:
         zkid = record.get("ZKID")
         timestamp_val = record.get("timestamp")
         if zkid is None or timestamp_val is None:
             print("Skipping record due to missing ZKID or timestamp:", record)
             continue
-        if not record_exists(cursor, zkid, timestamp_val):
-            cursor.execute('''
-                INSERT INTO attendance (ZKID, Timestamp, InorOut, attype, col1, col2, col3, col4, col5, col6, col7, SN, log_timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                record.get("ZKID"),
-                record.get("timestamp"),
-                record.get("inorout"),
-                record.get("attype"),
-                record.get("col1", ""),
-                record.get("col2", ""),
-                record.get("col3", ""),
-                record.get("col4", ""),
-                record.get("col5", ""),
-                record.get("col6", ""),
-                record.get("col7", ""),
-                record.get("SN", ""),
-                record.get("log_timestamp", "")
-            ))
+        key = (zkid, timestamp_val)
+        if key not in seen and key not in recent_keys:
+            rows.append(attendance_row(record))
         else:
             print("Duplicate record skipped (by file):", record)
-    conn.commit()
-    conn.close()
+        seen.add(key)
+    # One statement and one transaction for the whole file
+    changes = conn.total_changes
+    with conn:
+        insert_attendance_rows(cursor, rows)
+    ignored = len(rows) - (conn.total_changes - changes)
+    if ignored:
+        print(f"{ignored} duplicate records skipped (already in the database)")
+    # Only once the rows are committed: a failed pass is retried from the same offset
+    remember_keys(seen)
+    attlog_offset = end
     print("Finished processing attlog file.")
 
-def log_posting_json_sql(record_id, zk_id, in_or_out, attype, sn, timestamp_val, response_status, response_text):
+def log_posting_json_sql(record_id, zk_id, in_or_out, attype, sn, timestamp_val, response_status, response_data):
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
     log_entry = {
         "Posting JSON SQL ID": {
             "ZKID": zk_id,
@@ -397,98 +825,126 @@ def log_posting_json_sql(record_id, zk_id, in_or_out, attype, sn, timestamp_val,
             "SN": sn
         },
         "HTTP Status Code": response_status,
-        "Response Text": response_text,
+        "Response Data": response_data,
         "Message": f"Successfully updated record with id {record_id}",
         "Logged At": datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
     }
-    print(json.dumps(log_entry, indent=2))
+    logging.info("%s", jdumps(log_entry).decode())
+
+TIMESTAMP_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+# Columns sent to the API, in payload order
+POST_COLUMNS = ("ZKID", "Timestamp", "InorOut", "attype", "SN")
+SELECT_POST_SQL = f"SELECT id, {', '.join(POST_COLUMNS)} FROM attendance WHERE (RESPONSE IS NULL OR RESPONSE = '') AND id > ?"
+UPDATE_RESPONSE_SQL = "UPDATE attendance SET RESPONSE = ?, KEY = ?, FTID = ? WHERE id = ?"
+if sqlite3.sqlite_version_info >= (3, 35, 0):
+    # Hand the stored values back from the UPDATE itself instead of re-reading the row
+    UPDATE_RESPONSE_SQL += " RETURNING RESPONSE, KEY, FTID"
 
-def post_records():
-    conn = sqlite3.connect(DB_FILE)
+def post_records(after_id=0):
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM attendance")
+    # Only unposted rows past after_id come back. They are fetched up front so no read stays open across the POSTs and UPDATEs
+    cursor.execute(SELECT_POST_SQL, (after_id,))
     records = cursor.fetchall()
-    column_names = [desc[0] for desc in cursor.description]
-    conn.close()
-    for record in records:
-        response_val = record[column_names.index('RESPONSE')]
-        if response_val not in (None, ""):
-            print(f"Skipping record with id {record[column_names.index('id')]}: RESPONSE is set to {response_val}")
-            continue
-        exclude = {"id", "FTID", "RESPONSE", "KEY", "col1", "col2", "col3", "col4", "col5", "col6", "col7", "log_timestamp"}
-        record_dict = {column: value for column, value in zip(column_names, record) if column not in exclude}
-        for key, value in record_dict.items():
-            if isinstance(value, str) and '-' in value and ':' in value:
+    batches = [records[start:start + POST_BATCH_SIZE] for start in range(0, len(records), POST_BATCH_SIZE)]
+    # The POSTs mostly wait on the network, so several are in flight; results are stored here, on this thread's connection
+    with ThreadPoolExecutor(max_workers=POST_WORKERS, thread_name_prefix="post") as pool:
+        for record_ids, record_dicts, response in pool.map(post_batch, batches):
+            if response is not None:
+                store_post_results(conn, record_ids, record_dicts, response)
+    # The highest id tried, so the next pass can skip to rows added after it
+    return max((record[0] for record in records), default=after_id)
+
+def post_batch(records):
+    """POST one batch of attendance rows; returns their ids, the posted dicts and the response (None on a request error)."""
+    record_ids, record_dicts = [], []
+    for record_id, *values in records:
+        record_dict = dict(zip(POST_COLUMNS, values))
+        # Timestamp is the only date column: "YYYY-MM-DD HH:MM:SS" -> "YYYY/MM/DD HH:MM:SS"
+        timestamp_val = record_dict["Timestamp"]
+        if isinstance(timestamp_val, str) and TIMESTAMP_RE.match(timestamp_val):
+            record_dict["Timestamp"] = timestamp_val.replace('-', '/', 2)
+        record_ids.append(record_id)
+        record_dicts.append(record_dict)
+    # One record keeps the plain object body; a batch is sent as an array and answered with one result per record
+    record_json = jdumps(record_dicts[0] if len(record_dicts) == 1 else record_dicts)
+    logging.info("Posting JSON SQL ID %s: %s", ", ".join(map(str, record_ids)), record_json.decode())
+    try:
+        response = http_session.post(
+            POST_API_URL,
+            data=record_json,
+            headers=POST_HEADERS
+        )
+    except requests.exceptions.RequestException as e:
+        logging.error("Request exception: %s", e)
+        return record_ids, record_dicts, None
+    logging.debug("HTTP Status Code: %s", response.status_code)
+    # .text re-decodes the body, so only build it when it will be shown
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Response Text: %s", response.text)
+    return record_ids, record_dicts, response
+
+def store_post_results(conn, record_ids, record_dicts, response):
+    if response.status_code != 200:
+        logging.warning("Non-200 HTTP response: %s", response.status_code)
+        return
+    cursor = conn.cursor()
+    try:
+        results = jloads(response.content)
+        if not isinstance(results, list):
+            # e.g. {"error": ...} or null instead of one result per record
+            logging.warning("API returned error data: %s", response.text)
+            return
+        if len(results) < len(record_ids):
+            raise IndexError(f"{len(results)} results for {len(record_ids)} records")
+        for record_id, record_dict, response_data in zip(record_ids, record_dicts, results):
+            if isinstance(response_data, dict) and 'key' in response_data:
                 try:
-                    dt = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-                    record_dict[key] = dt.strftime("%Y/%m/%d %H:%M:%S")
-                except ValueError:
-                    pass
-        record_json = json.dumps(record_dict)
-        record_id = record[column_names.index('id')]
-        print(f"Posting JSON SQL ID {record_id}: {record_json}")
-        try:
-            response = requests.post(
-                POST_API_URL,
-                data=record_json,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {Token}'
-                }
-            )
-            print(f"HTTP Status Code: {response.status_code}")
-            print(f"Response Text: {response.text}")
-            if response.status_code == 200:
-                response_data = response.json()[0]
-                if 'key' in response_data:
-                    try:
-                        conn = sqlite3.connect(DB_FILE)
-                        cursor = conn.cursor()
-                        cursor.execute("""
-                            UPDATE attendance 
-                            SET RESPONSE = ?, KEY = ?, FTID = ? 
-                            WHERE id = ?
-                        """, (response_data['status'], response_data['key'], response_data['id'], record_id))
-                        conn.commit()
-                        conn.close()
-                        print(f"Successfully updated record with id {record_id}: RESPONSE={response_data['status']}, KEY={response_data['key']}, FTID={response_data['id']}")
-                        log_posting_json_sql(
-                            record_id,
-                            record_dict.get("ZKID", ""),
-                            record_dict.get("InorOut", ""),
-                            record_dict.get("attype", ""),
-                            record_dict.get("SN", ""),
-                            record_dict.get("Timestamp", ""),
-                            response.status_code,
-                            response.text
-                        )
-                    except sqlite3.Error as e:
-                        print(f"Failed to update record with id {record_id}: {e}")
-                    finally:
-                        conn.close()
-                else:
-                    print("API returned error data:", response_data)
+                    cursor.execute(UPDATE_RESPONSE_SQL, (response_data['status'], response_data['key'], response_data['id'], record_id))
+                    updated = cursor.fetchone() or (response_data['status'], response_data['key'], response_data['id'])
+                    conn.commit()
+                    logging.info("Successfully updated record with id %s: RESPONSE=%s, KEY=%s, FTID=%s", record_id, *updated)
+                    log_posting_json_sql(
+                        record_id,
+                        record_dict.get("ZKID", ""),
+                        record_dict.get("InorOut", ""),
+                        record_dict.get("attype", ""),
+                        record_dict.get("SN", ""),
+                        record_dict.get("Timestamp", ""),
+                        response.status_code,
+                        response_data
+                    )
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logging.error("Failed to update record with id %s: %s", record_id, e)
             else:
-                print(f"Non-200 HTTP response: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            print("Request exception:", e)
+                logging.warning("API returned error data: %s", response_data)
+    except (ValueError, IndexError) as e:
+        logging.error("Unexpected API response for records %s: %s", record_ids, e)
 
 def sync_loop():
+    last_retry = None
+    posted_through = 0
     while True:
         print("Processing attlog file...")
         process_attlog_file()
         print("Posting records from the database...")
-        post_records()
-        time.sleep(10)
+        # A wakeup only posts rows added since the last pass; rows the API rejected or never answered
+        # are retried with everything else still unposted, at most once per SYNC_INTERVAL
+        retry_due = last_retry is None or time.monotonic() - last_retry >= SYNC_INTERVAL
+        posted_through = max(posted_through, post_records(0 if retry_due else posted_through))
+        if retry_due:
+            last_retry = time.monotonic()
+        # Wake as soon as the writer appends; the clear comes after the wait so no append is missed
+        attlog_written.wait(SYNC_INTERVAL)
+        attlog_written.clear()
 
 # --- Main Entry Point ---
 def main():
     host = "0.0.0.0"
-    # Ensure attlog.json exists
-    if not os.path.exists(ATTLOG_FILE):
-        with open(ATTLOG_FILE, 'w') as f:
-            json.dump([], f)
-    q = Queue()
+    # Ensure the attlog file exists
+    open(ATTLOG_FILE, 'ab').close()
+    q = PacketQueue(maxsize=PACKET_QUEUE_BYTES)
     # Start the command server in its own thread
     command_thread = threading.Thread(target=lambda: run_command_server(host, devices, q, RUN_INTERVAL), daemon=True)
     command_thread.start()
@@ -507,4 +963,7 @@ def main():
         logging.info("Script stopped by user.")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["--export-json"]:
+        compact_to_json_array()
+    else:
+        main()